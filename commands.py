@@ -2,19 +2,31 @@
 This module offers a collection of static methods that can execute different commands.
 """
 
+import re
+import shlex
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from io import StringIO
 from contextlib import redirect_stdout
-from duckduckgo_search import DDGS
 
+# Maximum number of characters of shell output kept per stream
+MAX_SHELL_OUTPUT = 16384
 
-# pylint: disable=broad-exception-caught, exec-used, unspecified-encoding
+# Characters that need a shell to interpret them (pipes, redirects, variables, globs etc.)
+SHELL_SYNTAX = re.compile(r"[|&;<>()$`\\*?\[\]{}~#!=\n]")
+
+# pylint: disable=broad-exception-caught, exec-used, unspecified-encoding, import-outside-toplevel
 
 class Commands:
     """
     A collection of static methods that can execute different commands.
     """
 
+    # Globals shared by all execute_python calls, so that imports and definitions persist
+    python_globals = {"__name__": "__main__", "__builtins__": __builtins__}
+
     @staticmethod
     def execute_command(command, arg) -> str:
         """
@@ -28,18 +40,13 @@ class Commands:
             str: The result of the command execution, or an error 
                  message if an exception is raised during execution.
         """
+        handler = Commands.handlers.get(command)
+
+        if handler is None:
+            return f"Unknown command: {command}"
+
         try:
-            match command:
-                case "memorize_thoughts":
-                    result = Commands.memorize_thoughts(arg)
-                case "execute_python":
-                    result = Commands.execute_python(arg)
-                case "execute_shell":
-                    result = Commands.execute_shell(arg)
-                case "web_search":
-                    result = Commands.web_search(arg)
-                case _:
-                    result = f"Unknown command: {command}"
+            result = handler(arg)
         except Exception as exception:
             result = f"Command returned an error:\n{str(exception)}"
 
@@ -61,7 +68,8 @@ class Commands:
     @staticmethod
     def execute_python(arg: str) -> str:
         """
-        Executes the input Python code and returns the stdout.
+        Executes the input Python code and returns the stdout. Code runs in a persistent
+        namespace, so modules imported and names defined by earlier calls remain available.
 
         Args:
             arg (str): The input Python code.
@@ -69,12 +77,28 @@ class Commands:
         Returns:
             str: The stdout produced by the executed Python code.
         """
+        code = Commands.compile_python(arg)
+
         _stdout = StringIO()
         with redirect_stdout(_stdout):
-            exec(arg)
+            exec(code, Commands.python_globals)
 
         return _stdout.getvalue()
 
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def compile_python(arg: str):
+        """
+        Compiles Python code, reusing the code object for repeated snippets.
+
+        Args:
+            arg (str): The input Python code.
+
+        Returns:
+            code: The compiled code object.
+        """
+        return compile(arg, "<agent>", "exec")
+
     @staticmethod
     def execute_shell(arg: str) -> str:
         """
@@ -84,15 +108,83 @@ class Commands:
             arg (str): The input shell command.
 
         Returns:
-            str: The stdout and stderr produced by the executed shell command.
+            str: The stdout and stderr produced by the executed shell command. Only the
+                 last MAX_SHELL_OUTPUT characters of each stream are kept, following a
+                 note on how many characters were cut off.
         """
-        result = subprocess.run(arg, capture_output=True, shell=True, check=False)
+        argv = None
 
-        stdout = result.stdout.decode("utf-8")
-        stderr = result.stderr.decode("utf-8")
+        # Simple commands are executed directly, without forking an intermediate shell
+        if SHELL_SYNTAX.search(arg) is None:
+            try:
+                argv = shlex.split(arg)
+            except ValueError:
+                pass
+
+        try:
+            (stdout, stderr) = Commands.run_process(argv or arg, shell=not argv)
+        except OSError:
+            # Not an executable (e.g. a shell builtin like "cd"), let the shell handle it
+            (stdout, stderr) = Commands.run_process(arg, shell=True)
 
         return f"STDOUT:\n{stdout}\nSTDERR:\n{stderr}"
 
+    @staticmethod
+    def run_process(args, shell: bool) -> tuple:
+        """
+        Runs a process and collects the tail of its stdout and stderr while it runs,
+        so that commands with huge outputs never have their full output in memory.
+
+        Args:
+            args (str | list): The command line, or the program and its arguments.
+            shell (bool): Whether to run the command line through the shell.
+
+        Returns:
+            tuple: The last MAX_SHELL_OUTPUT characters of stdout and of stderr.
+        """
+        with subprocess.Popen(
+            args,
+            shell=shell,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace"
+        ) as process:
+            # Drain stderr in the background so that neither pipe can fill up and block
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                stderr = executor.submit(Commands.read_tail, process.stderr)
+                stdout = Commands.read_tail(process.stdout)
+
+                return (stdout, stderr.result())
+
+    @staticmethod
+    def read_tail(stream) -> str:
+        """
+        Reads a text stream to its end, keeping only the last MAX_SHELL_OUTPUT characters.
+
+        Args:
+            stream: The stream to read.
+
+        Returns:
+            str: The end of the stream's contents, starting with a note on how many
+                 characters were cut off if the stream was longer.
+        """
+        tail = ""
+        truncated = 0
+
+        while chunk := stream.read(8192):
+            tail += chunk
+
+            if len(tail) > MAX_SHELL_OUTPUT:
+                truncated += len(tail) - MAX_SHELL_OUTPUT
+                tail = tail[-MAX_SHELL_OUTPUT:]
+
+        if truncated:
+            # Tell the agent that the output it sees is not complete
+            return f"[... {truncated} characters truncated ...]\n{tail}"
+
+        return tail
+
     @staticmethod
     def web_search(arg: str) -> str:
         """
@@ -104,8 +196,20 @@ class Commands:
         Returns:
             str: The search results.
         """
+        # Imported on first use, as it is slow to load and most objectives never search
+        from duckduckgo_search import DDGS
+
         ddgs = DDGS()
 
         ddgs_text_gen = ddgs.text(arg)
 
-        return str(list(ddgs_text_gen)[:5])
+        # Stop consuming the generator early so DDGS doesn't fetch further result pages.
+        return str(list(islice(ddgs_text_gen, 5)))
+
+    # Maps command names to their handlers. Defined last so the static methods above exist.
+    handlers = {
+        "memorize_thoughts": memorize_thoughts,
+        "execute_python": execute_python,
+        "execute_shell": execute_shell,
+        "web_search": web_search,
+    }
@@ -5,20 +5,24 @@ its performance, and retaining memory of actions.
 """
 
 # pylint: disable=invalid-name, too-many-arguments, too-many-instance-attributes, unspecified-encoding
+# pylint: disable=import-outside-toplevel
 
 import os
 import sys
+import codecs
+import hashlib
 import re
 import platform
-import urllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from urllib.request import urlopen
 from dotenv import load_dotenv
 from termcolor import colored
 import openai
+import requests
 from thinkgpt.llm import ThinkGPT
 import tiktoken
-from bs4 import BeautifulSoup
 from spinner import Spinner
 from commands import Commands
 from exceptions import InvalidLLMResponseError
@@ -26,14 +30,10 @@ from exceptions import InvalidLLMResponseError
 
 operating_system = platform.platform()
 
+# The static instructions come before the objective and context so that every request
+# shares the same prompt prefix, which the API can serve from its prompt cache.
 PROMPT = f"You are an autonomous agent running on {operating_system}." + '''
-OBJECTIVE: {objective} (e.g. "Find a recipe for chocolate chip cookies")
-
-You are working towards the objective on a step-by-step basis. Previous steps:
-
-{context}
-
-Your task is to respond with the next action.
+You are working towards an objective on a step-by-step basis.
 Supported commands are: 
 
 command | argument
@@ -98,6 +98,14 @@ with open('hello_world.txt', 'w') as f:
     f.write('Hello, world!')
 
 <r>The objective is complete.</r><c>done</c>
+
+OBJECTIVE: {objective} (e.g. "Find a recipe for chocolate chip cookies")
+
+Previous steps:
+
+{context}
+
+Your task is to respond with the next action.
 '''
 
 CRITIC_PROMPT = '''
@@ -146,6 +154,21 @@ HISTORY_SUMMARY_HINT = "You are an autonomous agent summarizing your history."\
     "history and your latest action. Include a list of all previous actions. Keep it short."\
     "Use short sentences and abbrevations."
 
+# Local files larger than this (in bytes) are summarized while they are being read
+STREAMED_FILE_SIZE = 1 << 20
+
+# Only this many of the most recent memories are kept for the agent's context
+MAX_RECALLED_MEMORIES = 32
+
+# Connect and read timeouts (in seconds) for downloading web pages
+SCRAPE_TIMEOUT = (10, 30)
+
+# Web pages are downloaded in blocks of this size (in bytes)
+SCRAPE_BLOCK_SIZE = 1 << 16
+
+# Matches the reasoning and command of a response, the argument is everything after it
+RESPONSE_PATTERN = re.compile(r'^<r>(.*?)</r><c>(.*?)</c>\n*', flags=re.DOTALL | re.MULTILINE)
+
 class MiniAGI:
     """
     Represents an autonomous agent. 
@@ -157,12 +180,22 @@ class MiniAGI:
         max_context_size (int): The maximum size of the agent's short-term memory (in tokens).
         max_memory_item_size (int): The maximum size of a memory item (in tokens).
         debug (bool): Indicates whether to print debug information.
+        summarizer_concurrency (int): The maximum number of concurrent summarizer requests.
+        memories (deque): The agent's recent actions and observations with their size in tokens.
         summarized_history (str): The summarized history of the agent's actions.
         criticism (str): The criticism of the agent's last action.
         thought (str): The reasoning behind the agent's last action.
         proposed_command (str): The command proposed by the agent to be executed next.
         proposed_arg (str): The argument of the proposed command.
         encoding: The tokenizer's encoding of the agent model's vocabulary.
+        summarizer_encoding: The tokenizer's encoding of the summarizer model's vocabulary.
+        executor: A thread pool used to overlap independent API requests.
+        summary_cache (dict): Summaries of previously summarized chunks, keyed by content hash.
+        prefetcher: A single worker thread for downloading URLs ahead of time,
+            kept separate from the summarizer's pool.
+        prefetched (tuple): A URL being downloaded in the background and its pending result.
+        prompt (tuple): The agent prompt with the objective filled in, split around the context.
+        critic_prompt (tuple): The critic prompt with the objective filled in, split likewise.
     """
 
     def __init__(
@@ -172,7 +205,8 @@ class MiniAGI:
         objective: str,
         max_context_size: int,
         max_memory_item_size: int,
-        debug: bool = False
+        debug: bool = False,
+        summarizer_concurrency: int = 5
         ):
         """
         Constructs a `MiniAGI` instance.
@@ -184,6 +218,8 @@ class MiniAGI:
             max_context_size (int): The maximum context size in tokens for the agent's memory.
             max_memory_item_size (int): The maximum size of a memory item in tokens.
             debug (bool, optional): A flag to indicate whether to print debug information.
+            summarizer_concurrency (int, optional): The maximum number of concurrent
+                summarizer requests.
         """
 
         self.agent = ThinkGPT(
@@ -201,18 +237,128 @@ class MiniAGI:
         self.max_context_size = max_context_size
         self.max_memory_item_size = max_memory_item_size
         self.debug = debug
+        self.summarizer_concurrency = summarizer_concurrency
 
+        self.memories = deque(maxlen=MAX_RECALLED_MEMORIES)
         self.summarized_history = ""
         self.criticism = ""
         self.thought = ""
         self.proposed_command = ""
         self.proposed_arg = ""
 
-        self.encoding = tiktoken.encoding_for_model(self.agent.model_name)
+        self.encoding = get_encoding(self.agent.model_name)
+        self.summarizer_encoding = get_encoding(self.summarizer.model_name)
+        self.executor = ThreadPoolExecutor(max_workers=summarizer_concurrency)
+        self.summary_cache = {}
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.prefetched = None
+
+        self.prompt = bind_objective(PROMPT, objective)
+        self.critic_prompt = bind_objective(CRITIC_PROMPT, objective)
+
+    def __summarize_chunk(self, chunk: str, max_tokens: int, instruction_hint: str) -> str:
+        """
+        Summarizes a single chunk, reusing the summary if the same chunk was summarized
+        before, e.g. when the agent reads the same file or URL again.
+
+        Args:
+            chunk (str): The content to summarize.
+            max_tokens (int): The maximum size of the summary in tokens.
+            instruction_hint (str): Additional instructions for the summarizer.
+
+        Returns:
+            str: The summary.
+        """
+
+        key = hashlib.sha256(f"{max_tokens}|{instruction_hint}|{chunk}".encode()).digest()
+
+        if key not in self.summary_cache:
+            self.summary_cache[key] = self.summarizer.summarize(
+                chunk, max_tokens,
+                instruction_hint=instruction_hint
+                )
+
+        return self.summary_cache[key]
+
+    def __decode_chunks(self, tokens: list, chunk_size: int) -> list:
+        """
+        Splits tokens into chunks of chunk_size tokens and decodes each chunk. The bytes of
+        a character that spans two chunks are carried over to the second one, rather than
+        being decoded into replacement characters on both sides of the boundary.
+
+        Args:
+            tokens (list): The tokens to split, encoded with the summarizer's encoding.
+            chunk_size (int): The number of tokens per chunk.
+
+        Returns:
+            list: The decoded chunks.
+        """
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        return [
+            decoder.decode(
+                self.summarizer_encoding.decode_bytes(tokens[i:i + chunk_size]),
+                final=i + chunk_size >= len(tokens)
+            )
+            for i in range(0, len(tokens), chunk_size)
+        ]
+
+    def __chunked_summarize(
+            self,
+            content: str,
+            max_tokens: int,
+            instruction_hint: str = ""
+        ) -> str:
+        """
+        Summarizes content that exceeds a token limit. The content is split into chunks
+        which are summarized concurrently and concatenated in their original order.
+
+        Args:
+            content (str): The content to summarize.
+            max_tokens (int): The maximum size of the summary in tokens.
+            instruction_hint (str, optional): Additional instructions for the summarizer.
+
+        Returns:
+            str: The summarized content, or the original content if it fits.
+        """
+
+        # Every token encodes at least one byte, so short content can skip the tokenizer
+        if len(content.encode("utf-8")) <= max_tokens:
+            return content
+
+        tokens = self.summarizer_encoding.encode(content)
+
+        if len(tokens) <= max_tokens:
+            return content
+
+        # Split on token boundaries so every chunk fits the summarizer's chunk size exactly
+        chunk_size = self.summarizer.summarize_chain.summarizer_chunk_size
+        starts = range(0, len(tokens), chunk_size)
+        chunks = self.__decode_chunks(tokens, chunk_size)
+
+        # Share the summary size in proportion to each chunk's size in tokens,
+        # so the last, usually shorter chunk does not get as much room as the others
+        summary_sizes = [
+            max(1, max_tokens * min(chunk_size, len(tokens) - i) // len(tokens))
+            for i in starts
+        ]
+
+        # The pool runs at most summarizer_concurrency requests at a time. Rate limited
+        # requests are retried with exponential backoff by the OpenAI client wrapper.
+        summaries = self.executor.map(
+            lambda chunk, summary_size: self.__summarize_chunk(
+                chunk, summary_size, instruction_hint
+            ),
+            chunks, summary_sizes
+        )
+
+        return "".join(summaries)
 
     def __update_memory(
             self,
-            action: str,
+            _command: str,
+            _arg: str,
             observation: str,
             update_summary: bool = True
         ):
@@ -221,23 +367,23 @@ class MiniAGI:
         Optionally, updates the summary of agent's history as well.
 
         Args:
-            action (str): The action performed by the ThinkGPT instance.
+            _command (str): The command performed by the ThinkGPT instance.
+            _arg (str): The argument of the command.
             observation (str): The observation made by the ThinkGPT 
                 instance after performing the action.
             summary (str): The current summary of the agent's history.
             update_summary (bool, optional): Determines whether to update the summary.
         """
 
-        if len(self.encoding.encode(observation)) > self.max_memory_item_size:
-            observation = self.summarizer.chunked_summarize(
-                observation, self.max_memory_item_size,
-                instruction_hint=OBSERVATION_SUMMARY_HINT
-                )
+        observation = self.__chunked_summarize(
+            observation, self.max_memory_item_size,
+            instruction_hint=OBSERVATION_SUMMARY_HINT
+            )
 
-        if "memorize_thoughts" in action:
+        if _command == "memorize_thoughts":
             new_memory = f"ACTION:\nmemorize_thoughts\nTHOUGHTS:\n{observation}\n"
         else:
-            new_memory = f"ACTION:\n{action}\nRESULT:\n{observation}\n"
+            new_memory = f"ACTION:\n{_command}\n{_arg}\nRESULT:\n{observation}\n"
 
         if update_summary:
             self.summarized_history = self.summarizer.summarize(
@@ -246,7 +392,47 @@ class MiniAGI:
                 instruction_hint=HISTORY_SUMMARY_HINT
                 )
 
-        self.agent.memorize(new_memory)
+        # The size is counted once here instead of each time the context is assembled
+        self.memories.append((new_memory, len(self.encoding.encode(new_memory))))
+
+    def __remember(self, max_tokens: int) -> list:
+        """
+        Recalls the agent's most recent memories in chronological order, skipping duplicates.
+        If they don't all fit, the oldest memories are left out. The newest memory is
+        always recalled, if necessary shortened to its last max_tokens tokens.
+
+        Args:
+            max_tokens (int): The maximum total size of the recalled memories in tokens.
+
+        Returns:
+            list: The recalled memories.
+        """
+
+        memories = []
+        seen = set()
+        total_tokens = 0
+
+        for (memory, tokens) in reversed(self.memories):
+            # Repeated actions with identical results only need to be shown once
+            if memory in seen:
+                continue
+
+            seen.add(memory)
+            total_tokens += tokens
+
+            if total_tokens > max_tokens:
+                if not memories and max_tokens > 0:
+                    # Keep the end of the latest memory, so the agent sees its last result
+                    tail = self.encoding.encode(memory)[-max_tokens:]
+                    memories.append(f"[...]\n{self.encoding.decode(tail)}")
+
+                break
+
+            memories.append(memory)
+
+        memories.reverse()
+
+        return memories
 
     def __get_context(self) -> str:
         """
@@ -264,9 +450,7 @@ class MiniAGI:
             criticism_len = 0
 
         action_buffer = "\n".join(
-                self.agent.remember(
-                limit=32,
-                sort_by_order=True,
+                self.__remember(
                 max_tokens=self.max_context_size - summary_len - criticism_len
             )
         )
@@ -283,8 +467,10 @@ class MiniAGI:
 
         context = self.__get_context()
 
+        (head, tail) = self.critic_prompt
+
         self.criticism = self.agent.predict(
-                prompt=CRITIC_PROMPT.format(context=context, objective=self.objective)
+                prompt=f"{head}{context}{tail}"
             )
 
         return self.criticism
@@ -299,26 +485,25 @@ class MiniAGI:
         if self.debug:
             print(context)
 
+        (head, tail) = self.prompt
+
         response_text = self.agent.predict(
-            prompt=PROMPT.format(context=context, objective=self.objective)
+            prompt=f"{head}{context}{tail}"
         )
 
         if self.debug:
             print(f"RAW RESPONSE:\n{response_text}")
 
-        PATTERN = r'^<r>(.*?)</r><c>(.*?)</c>\n*(.*)$'
-
         try:
-            match = re.search(PATTERN, response_text, flags=re.DOTALL | re.MULTILINE)
+            match = RESPONSE_PATTERN.search(response_text)
 
             _thought = match[1]
             _command = match[2]
-            _arg = match[3]
         except Exception as exc:
             raise InvalidLLMResponseError from exc
 
         # Remove unwanted code formatting backticks
-        _arg = _arg.replace("```", "")
+        _arg = response_text[match.end():].replace("```", "")
 
         self.thought = _thought
         self.proposed_command = _command
@@ -353,19 +538,107 @@ class MiniAGI:
             str: Observation: The contents of the URL or file.
         """
 
-        if arg.startswith("http://") or arg.startswith("https://"):
-            with urlopen(_arg) as response:
-                html = response.read()
-            data = BeautifulSoup(
-                    html,
-                    features="lxml"
-                ).get_text()
+        if _arg.startswith("http://") or _arg.startswith("https://"):
+            # Imported on first use to keep startup fast for objectives that never scrape
+            import lxml.etree
+            import lxml.html
+
+            # The page is downloaded in blocks but parsed in one call: lxml's incremental
+            # parser can miss a </script> or </style> end tag that spans two blocks
+            with scrape_session.get(_arg, stream=True, timeout=SCRAPE_TIMEOUT) as response:
+                response.raise_for_status()
+                html = b"".join(response.iter_content(SCRAPE_BLOCK_SIZE))
+
+            try:
+                # Extract the text from lxml's C tree directly instead of wrapping
+                # every node in a Python object first, as BeautifulSoup does.
+                # Scripts and stylesheets are dropped so they are not summarized.
+                tree = lxml.html.document_fromstring(html)
+                for element in tree.xpath("//script|//style"):
+                    element.drop_tree()
+                data = tree.text_content()
+            except lxml.etree.ParserError:
+                # The page has no elements or text, e.g. it is empty
+                data = ""
         else:
             with open(_arg, "r") as file:
                 data = file.read()
 
         return data
 
+    def __summarize_file(self, path: str, max_tokens: int) -> str:
+        """
+        Summarizes a large local file block by block while reading it, so the whole
+        file is never held in memory. The chunk summaries are merged at the end.
+
+        Args:
+            path (str): The file to summarize.
+            max_tokens (int): The maximum size of the summary in tokens.
+
+        Returns:
+            str: The summarized file contents.
+        """
+
+        chunk_size = self.summarizer.summarize_chain.summarizer_chunk_size
+
+        # Every chunk is condensed to a fixed size, regardless of the size of the file.
+        # The merge at the end reduces the chunk summaries to max_tokens.
+        summary_size = max(1, min(max_tokens, chunk_size // 4))
+
+        summaries = []
+        pending = deque()
+
+        with open(path, "r") as file:
+            # Blocks of roughly summarizer_chunk_size tokens, assuming ~4 characters per
+            # token. Each block is split by its actual token count before it is summarized.
+            while block := file.read(4 * chunk_size):
+                tokens = self.summarizer_encoding.encode(block)
+
+                for chunk in self.__decode_chunks(tokens, chunk_size):
+                    # Don't read further ahead than the summarizer can keep up with
+                    if len(pending) >= self.summarizer_concurrency:
+                        summaries.append(pending.popleft().result())
+
+                    pending.append(self.executor.submit(
+                        self.__summarize_chunk,
+                        chunk, summary_size, OBSERVATION_SUMMARY_HINT
+                        ))
+
+        summaries.extend(summary.result() for summary in pending)
+
+        return self.__chunked_summarize(
+            "".join(summaries), max_tokens,
+            instruction_hint=OBSERVATION_SUMMARY_HINT
+            )
+
+    def __load_data(self, _arg: str, max_tokens: int) -> str:
+        """
+        Loads data from a URL or file and summarizes it if it exceeds the token limit.
+
+        Args:
+            _arg (str): URL or filename
+            max_tokens (int): The maximum size of the data in tokens.
+
+        Returns:
+            str: The (summarized) contents of the URL or file.
+        """
+
+        if os.path.isfile(_arg) and os.path.getsize(_arg) > STREAMED_FILE_SIZE:
+            return self.__summarize_file(_arg, max_tokens)
+
+        (prefetched_url, download) = self.prefetched or (None, None)
+        self.prefetched = None
+
+        if prefetched_url == _arg:
+            data = download.result()
+        else:
+            data = self.__get_url_or_file(_arg)
+
+        return self.__chunked_summarize(
+            data, max_tokens,
+            instruction_hint=OBSERVATION_SUMMARY_HINT
+            )
+
     def __process_data(self, _arg: str) -> str:
         """
         Processes data from a URL or file.
@@ -387,18 +660,12 @@ class MiniAGI:
         (prompt, __arg) = args
 
         try:
-            input_data = self.__get_url_or_file(__arg)
-        except urllib.error.URLError as e:
+            input_data = self.__load_data(__arg, self.max_context_size)
+        except requests.RequestException as e:
             return f"Error: {str(e)}"
         except OSError as e:
             return f"Error: {str(e)}"
 
-        if len(self.encoding.encode(input_data)) > self.max_context_size:
-            input_data = self.summarizer.chunked_summarize(
-                input_data, self.max_context_size,
-                instruction_hint=OBSERVATION_SUMMARY_HINT
-                )
-
         return self.agent.predict(
                 prompt=f"{RETRIEVAL_PROMPT}\n{prompt}\nINPUT DATA:\n{input_data}"
             )
@@ -415,32 +682,44 @@ class MiniAGI:
         """
 
         try:
-            data = self.__get_url_or_file(_arg)
-        except urllib.error.URLError as e:
+            data = self.__load_data(_arg, self.max_memory_item_size)
+        except requests.RequestException as e:
             return f"Error: {str(e)}"
         except OSError as e:
             return f"Error: {str(e)}"
 
-        if len(self.encoding.encode(data)) > self.max_memory_item_size:
-            data = self.summarizer.chunked_summarize(
-                data, self.max_memory_item_size,
-                instruction_hint=OBSERVATION_SUMMARY_HINT
-                )
-
         return data
 
+    def prefetch(self):
+        """
+        Starts downloading the URL of a proposed ingest_data or process_data command in
+        the background, so that the download overlaps with waiting for the user.
+        The download is only used if the command is subsequently executed.
+        Note that the URL is requested even if the user then aborts the command.
+        """
+
+        if self.proposed_command == "ingest_data":
+            url = self.proposed_arg
+        elif self.proposed_command == "process_data" and self.proposed_arg.count("|") == 1:
+            url = self.proposed_arg.split("|")[1]
+        else:
+            return
+
+        if url.startswith("http://") or url.startswith("https://"):
+            self.prefetched = (url, self.prefetcher.submit(self.__get_url_or_file, url))
+
     def act(self):
         """
         Executes the command proposed by the agent and updates the agent's memory.
         """
-        if command == "process_data":
+        if self.proposed_command == "process_data":
             obs = self.__process_data(self.proposed_arg)
-        elif command == "ingest_data":
+        elif self.proposed_command == "ingest_data":
             obs = self.__ingest_data(self.proposed_arg)
         else:
             obs = Commands.execute_command(self.proposed_command, self.proposed_arg)
 
-        self.__update_memory(f"{self.proposed_command}\n{self.proposed_arg}", obs)
+        self.__update_memory(self.proposed_command, self.proposed_arg, obs)
         self.criticism = ""
 
     def user_response(self, response):
@@ -450,8 +729,29 @@ class MiniAGI:
         Args:
             response (str): The user's response to the agent's last action.
         """
-        self.__update_memory(f"{self.proposed_command}\n{self.proposed_arg}", response)
+        self.__update_memory(self.proposed_command, self.proposed_arg, response)
         self.criticism = ""
+        self.prefetched = None
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    '''
+    Gets the tokenizer encoding of a model. Each encoding is only built once.
+    Args:
+        model (str): Name of the model
+    '''
+    return tiktoken.encoding_for_model(model)
+
+def bind_objective(template: str, objective: str) -> tuple:
+    '''
+    Fills in the objective of a prompt template and splits it around the context
+    placeholder, so only the context needs to be inserted on each step.
+    Args:
+        template (str): The prompt template
+        objective (str): The objective of the agent
+    '''
+    (head, tail) = template.split("{context}")
+    return (head.replace("{objective}", objective), tail)
 
 def get_bool_env(env_var: str) -> bool:
     '''
@@ -465,10 +765,21 @@ def get_bool_env(env_var: str) -> bool:
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# Share one keep-alive connection pool between all threads issuing API requests
+openai.requestssession = requests.Session()
+openai.requestssession.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(pool_maxsize=16, max_retries=2)
+)
+
+# Keep connections to scraped hosts alive across ingest_data and process_data commands
+scrape_session = requests.Session()
+
 if __name__ == "__main__":
 
     PROMPT_USER = get_bool_env("PROMPT_USER")
     ENABLE_CRITIC = get_bool_env("ENABLE_CRITIC")
+    PREFETCH_URLS = get_bool_env("PREFETCH_URLS")
 
     if len(sys.argv) != 2:
         print("Usage: miniagi.py <objective>")
@@ -495,7 +806,8 @@ if __name__ == "__main__":
         sys.argv[1],
         int(os.getenv("MAX_CONTEXT_SIZE")),
         int(os.getenv("MAX_MEMORY_ITEM_SIZE")),
-        get_bool_env("DEBUG")
+        get_bool_env("DEBUG"),
+        int(os.getenv("SUMMARIZER_CONCURRENCY", "5"))
     )
 
     while True:
@@ -525,6 +837,10 @@ if __name__ == "__main__":
             print(colored("MiniAGI is thinking:\n"\
                 f"{miniagi.proposed_arg}", 'cyan'))
         elif PROMPT_USER:
+            # Opt-in, since the URL is requested before the user has approved the action
+            if PREFETCH_URLS:
+                miniagi.prefetch()
+
             user_input = input('Press enter to continue or abort this action by typing feedback: ')
 
             if len(user_input) > 0: